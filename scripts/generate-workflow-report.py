@@ -10,15 +10,128 @@ Usage:
     python3 scripts/generate-workflow-report.py
     python3 scripts/generate-workflow-report.py --open
     python3 scripts/generate-workflow-report.py --baseline tests/emulator/baseline
+    python3 scripts/generate-workflow-report.py --embed-images small
+    python3 scripts/generate-workflow-report.py --no-images
+    python3 scripts/generate-workflow-report.py --cache
+
+Optional speedups (used when installed, stdlib fallback otherwise):
+    pybase64  SIMD base64 encoding of embedded images
+    orjson    faster parsing of report.json and the encode cache
+    Pillow    re-encoding screenshots as JPEG/WebP (--image-format)
 """
 
 import argparse
 import base64
+import hashlib
+import html
+import io
+import itertools
 import json
+import mimetypes
+import mmap
 import os
+import re
+import shutil
 import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 from datetime import datetime, timezone
+from urllib.parse import quote
+
+# pybase64 ships a SIMD (AVX2/NEON) codec that is an order of magnitude faster
+# than the stdlib on multi-MB screenshots. Only use it when the SIMD build is
+# actually active; otherwise the stdlib is just as good.
+try:
+    import pybase64
+    _simd_path = getattr(pybase64, "_get_simd_path", None)
+    if not (_simd_path and _simd_path() > 0):
+        raise ImportError("pybase64 SIMD path not active")
+    b64encode_str = pybase64.b64encode_as_string
+    b64decode = pybase64.b64decode
+except ImportError:
+    def b64encode_str(data):
+        return base64.b64encode(data).decode()
+    b64decode = base64.b64decode
+
+# orjson parses from bytes directly, skipping the text decode pass
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Default worker count for parallel image reads (I/O-bound, so oversubscribe
+# the CPUs; raise it with --io-workers on slow or network-mounted disks)
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Slice size for streamed base64 encoding. Must be a multiple of 3 so the
+# encoded chunks concatenate without padding in between.
+STREAM_CHUNK = 48 * 1024
+
+# Output buffer for writing the report
+WRITE_BUFFER = 1024 * 1024
+
+# With --embed-images small, images below this size are inlined and larger
+# ones are copied to the assets directory next to the report
+EMBED_SMALL_LIMIT = 64 * 1024
+
+# PNGs below this size are embedded as-is; re-encoding them saves little
+TRANSCODE_MIN_SIZE = 16 * 1024
+TRANSCODE_QUALITY = 82
+
+# Test titles and step names repeat across projects and retries, so escape
+# each distinct string once
+esc = lru_cache(maxsize=4096)(html.escape)
+
+# Image handling used when the caller does not pass options
+DEFAULT_IMAGE_OPTS = {
+    "include": True, "embed": "always", "assets_dir": None, "format": "png", "cache": None,
+}
+
+# Pre-rendered badges for the common result statuses
+BADGES = {
+    "passed": '<span class="badge pass">PASSED</span>',
+    "failed": '<span class="badge fail">FAILED</span>',
+    "skipped": '<span class="badge skip">SKIPPED</span>',
+}
+
+# Step screenshot name fragment -> narrative shown under the screenshot
+NARRATIVES = {
+    "fresh-start": "Application loaded with cleared state (localStorage wiped, page reloaded)",
+    "connected": "SSH connection established via the test SSH server",
+    "scrollback-generated": "Terminal filled with scrollback content (seq 1 100)",
+    "after-swipe-up": "Vertical swipe up performed on terminal (scroll back through output)",
+    "after-second-swipe": "Second vertical swipe up (continued scrolling)",
+    "tmux-started": "tmux session started inside SSH connection",
+    "tmux-second-window": "Second tmux window created (Ctrl-B c)",
+    "after-swipe-left": "Horizontal swipe left (should trigger tmux prev window)",
+    "after-swipe-right": "Horizontal swipe right (should trigger tmux next window)",
+    "terminal-loaded": "Terminal view loaded, ready for interaction",
+    "settings-panel": "Navigated to Settings panel via tab bar",
+    "after-pinch-zoom-in": "Pinch-to-zoom gesture performed on settings panel",
+    "back-to-terminal": "Navigated back to terminal view after zoom test",
+}
+# Longest keys first so the alternation prefers the most specific match
+NARRATIVE_RE = re.compile("|".join(re.escape(k) for k in sorted(NARRATIVES, key=len, reverse=True)))
+
+# Frame filename: <test-prefix>-<order>-<label>, e.g. foo-bar-1-midpoint
+FRAME_RE = re.compile(r"^(.+?)-(\d+[a-z]?)-(.+)$")
+# Runs of non-alphanumerics, collapsed to "-" when normalizing test titles
+NORM_RE = re.compile(r"[^a-zA-Z0-9]+")
+# A standard-alphabet base64 payload, as Playwright writes inline attachment bodies
+BASE64_RE = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Generate workflow exploration HTML report")
@@ -28,7 +141,23 @@ def main():
                         help="Open the report in a browser after generating")
     parser.add_argument("--output", default=None,
                         help="Output HTML path (default: <baseline>/workflow-report.html)")
+    parser.add_argument("--embed-images", choices=["always", "never", "small"], default="always",
+                        help="Inline images as base64, or link them from <output dir>/assets/ "
+                             f"(small: inline only images under {EMBED_SMALL_LIMIT // 1024} KB)")
+    parser.add_argument("--image-format", choices=["png", "jpeg", "webp"], default=None,
+                        help="Re-encode embedded PNG screenshots when that makes them smaller "
+                             "(default: jpeg if Pillow is installed, else png)")
+    parser.add_argument("--images", action=argparse.BooleanOptionalAction, default=None,
+                        help="Include screenshots and video frames (default: on, except "
+                             "off in CI when stdout is not a terminal)")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse base64 images from <output>.cache.json for files whose "
+                             "mtime and size are unchanged, and update it afterwards")
+    parser.add_argument("--io-workers", type=int, default=IO_WORKERS,
+                        help=f"Concurrent frame reads (default: {IO_WORKERS})")
     args = parser.parse_args()
+    if args.io_workers < 1:
+        parser.error("--io-workers must be at least 1")
 
     baseline = Path(args.baseline)
     report_path = baseline / "report.json"
@@ -36,15 +165,41 @@ def main():
     video_path = baseline / "recording.mp4"
     output_path = Path(args.output) if args.output else baseline / "workflow-report.html"
 
+    image_format = args.image_format or ("jpeg" if Image else "png")
+    if image_format != "png" and Image is None:
+        print(f"Warning: Pillow not installed, embedding PNGs instead of {image_format}",
+              file=sys.stderr)
+        image_format = "png"
+
+    include_images = args.images
+    if include_images is None:
+        include_images = not (os.environ.get("CI") and not sys.stdout.isatty())
+        if not include_images:
+            print("Note: CI detected, images skipped; pass --images to include them",
+                  file=sys.stderr)
+
+    images = {
+        "include": include_images,
+        "embed": args.embed_images,
+        "assets_dir": output_path.parent / "assets",
+        "format": image_format,
+        "cache": None,
+    }
+
+    cache_path = output_path.with_name(output_path.stem + ".cache.json")
+    if args.cache:
+        images["cache"] = {"entries": load_encode_cache(cache_path), "used": {}}
+
     if not report_path.exists():
         print(f"Error: {report_path} not found. Run emulator tests first.", file=sys.stderr)
         sys.exit(1)
 
-    with open(report_path) as f:
-        report = json.load(f)
+    report = json_loads(report_path.read_bytes())
 
-    tests = collect_tests(report)
-    frames = collect_frames(frames_dir) if frames_dir.exists() else {}
+    suites, passed, failed, total = collect_tests(report)
+    frames = {}
+    if include_images and frames_dir.exists():
+        frames = collect_frames(frames_dir, images, args.io_workers)
     has_video = video_path.exists()
     video_rel = os.path.relpath(video_path, output_path.parent) if has_video else None
 
@@ -52,11 +207,23 @@ def main():
     start_time = stats.get("startTime", "")
     duration_ms = stats.get("duration", 0)
 
-    html = render_html(tests, frames, video_rel, start_time, duration_ms)
-
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, "w") as f:
-        f.write(html)
+    # Stream fragments straight to disk so image payloads are never
+    # concatenated into one giant HTML string; a large buffer batches the
+    # many small markup fragments into few writes
+    with open(output_path, "w", buffering=WRITE_BUFFER) as f:
+        f.writelines(render_html(suites, passed, failed, total, frames, video_rel,
+                                 start_time, duration_ms, images))
+
+    if images["cache"] is not None:
+        # Merge this run's entries into the loaded cache, so runs that encode
+        # nothing (--no-images, --embed-images never) keep it intact; entries
+        # for files that no longer exist are dropped so it cannot grow forever
+        cache = images["cache"]
+        entries = {path: entry for path, entry in cache["entries"].items()
+                   if os.path.exists(path)}
+        entries.update(cache["used"])
+        save_encode_cache(cache_path, entries)
 
     print(f"Report: {output_path}")
 
@@ -66,81 +233,167 @@ def main():
 
 
 def collect_tests(report):
-    """Walk the nested suite structure and extract test results with attachments."""
-    tests = []
-
-    def walk(suites):
-        for suite in suites:
-            suite_title = suite.get("title", "")
-            for spec in suite.get("specs", []):
-                spec_title = spec.get("title", "")
-                for test in spec.get("tests", []):
-                    project = test.get("projectName", "")
-                    for result in test.get("results", []):
-                        tests.append({
-                            "suite": suite_title,
-                            "title": spec_title,
-                            "project": project,
-                            "status": result.get("status", "unknown"),
-                            "duration": result.get("duration", 0),
-                            "startTime": result.get("startTime", ""),
-                            "error": result.get("error", {}).get("message", ""),
-                            "attachments": result.get("attachments", []),
-                        })
-            walk(suite.get("suites", []))
-
-    walk(report.get("suites", []))
-    return tests
-
-
-def collect_frames(frames_dir):
-    """Group video frames by test name prefix."""
+    """Walk the nested suite structure and extract test results with attachments.
+
+    Returns (suites, passed, failed, total), where suites maps each suite title
+    to its results in report order.
+    """
+    suites = {}
+    passed = failed = total = 0
+
+    # Depth-first with an explicit stack; children are pushed in reverse so
+    # suites are still visited in report order
+    stack = list(reversed(report.get("suites", [])))
+    while stack:
+        suite = stack.pop()
+        suite_title = suite.get("title", "")
+        suite_tests = None
+        for spec in suite.get("specs", []):
+            spec_title = spec.get("title", "")
+            for test in spec.get("tests", []):
+                project = test.get("projectName", "")
+                for result in test.get("results", []):
+                    status = result.get("status", "unknown")
+                    if status == "passed":
+                        passed += 1
+                    elif status == "failed":
+                        failed += 1
+                    total += 1
+                    if suite_tests is None:
+                        suite_tests = suites.setdefault(suite_title or "Ungrouped", [])
+                    suite_tests.append({
+                        "suite": suite_title,
+                        "title": spec_title,
+                        "project": project,
+                        "status": status,
+                        "duration": result.get("duration", 0),
+                        "startTime": result.get("startTime", ""),
+                        "error": result.get("error", {}).get("message", ""),
+                        "attachments": result.get("attachments", []),
+                    })
+        stack.extend(reversed(suite.get("suites", [])))
+
+    return suites, passed, failed, total
+
+
+def collect_frames(frames_dir, images=DEFAULT_IMAGE_OPTS, workers=IO_WORKERS):
+    """Group video frames by test name prefix, each group in frame order."""
+    # scandir yields names and file types without building Path objects;
+    # sizes are only stat'ed when a frame actually needs one (encode_frame)
+    with os.scandir(frames_dir) as it:
+        entries = [e for e in it if e.name.endswith(".png") and e.is_file()]
+
+    # Parse every name up front and sort once by (prefix, numeric order), so
+    # groups come out contiguous and already ordered ("10" after "9")
+    parsed = []
+    for entry in entries:
+        test_prefix, frame_order, frame_label = parse_frame_name(entry.name[:-len(".png")])
+        parsed.append((test_prefix, frame_order_key(frame_order), entry.name,
+                       frame_order, frame_label, entry))
+    parsed.sort(key=lambda p: p[:3])
+
+    # File reads and base64 encoding both release the GIL, so threads overlap
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        srcs = list(ex.map(partial(encode_frame, images=images), (p[-1] for p in parsed)))
+
     frames = {}
-    for png in sorted(frames_dir.glob("*.png")):
-        # Frame names: prefix-0-before.png, prefix-1-midpoint.png, etc.
-        name = png.stem
-        # Split off the frame suffix (e.g., -0-before, -1-midpoint, -2-end-failed)
-        parts = name.rsplit("-", 2)
-        if len(parts) >= 3:
-            # e.g. "explore-workflow-clear-SSH-login-...-vertical-swipe" + "0" + "before"
-            test_prefix = parts[0]
-        else:
-            test_prefix = name
-
-        # More robust: find the -N- pattern that separates prefix from frame label
-        import re
-        m = re.match(r"^(.+?)-(\d+[a-z]?)-(.+)$", name)
-        if m:
-            test_prefix = m.group(1)
-            frame_order = m.group(2)
-            frame_label = m.group(3)
-        else:
-            test_prefix = name
-            frame_order = "0"
-            frame_label = "unknown"
-
-        if test_prefix not in frames:
-            frames[test_prefix] = []
-
-        with open(png, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-
-        frames[test_prefix].append({
+    for test_prefix, group in itertools.groupby(zip(parsed, srcs), key=lambda x: x[0][0]):
+        frames[test_prefix] = [{
             "order": frame_order,
             "label": frame_label,
-            "b64": b64,
-            "filename": png.name,
-        })
-
-    # Sort each group by order
-    for prefix in frames:
-        frames[prefix].sort(key=lambda x: x["order"])
+            "src": src,
+            "filename": filename,
+        } for (_, _, filename, frame_order, frame_label, _), src in group]
 
     return frames
 
 
-def img_from_attachment(att):
-    """Extract a base64 image from an attachment dict."""
+def parse_frame_name(name):
+    """Split a frame name (without extension) into (test_prefix, order, label)."""
+    # Frame names: prefix-0-before.png, prefix-1-midpoint.png, etc.
+    # The -N- pattern separates the prefix from the frame label
+    # (e.g., -0-before, -1-midpoint, -2-end-failed)
+    m = FRAME_RE.match(name)
+    if m:
+        return m.groups()
+    return name, "0", "unknown"
+
+
+def frame_order_key(frame_order):
+    """Sort key for a frame order like "2" or "2a": numeric part, then suffix."""
+    digits = frame_order.rstrip("abcdefghijklmnopqrstuvwxyz")
+    return int(digits), frame_order[len(digits):]
+
+
+def encode_frame(entry, images=DEFAULT_IMAGE_OPTS):
+    """Produce the image src of a frame's os.DirEntry as a tuple of fragments."""
+    # DirEntry.stat() is a real stat(2) on Linux, so only pay for it when the
+    # embed decision, re-encoding threshold or cache stamp needs the result
+    st = None
+    if images["embed"] != "always" or images["format"] != "png" or images["cache"] is not None:
+        st = entry.stat()
+        if not should_embed(st.st_size, images["embed"]):
+            return (export_asset(entry.path, images["assets_dir"]),)
+    content_type, b64 = encode_file_with_cache(entry.path, "image/png", images, st)
+    return (f"data:{content_type};base64,", b64)
+
+
+def should_embed(size, embed):
+    """Decide whether an image of the given byte size is inlined as base64."""
+    if embed == "small":
+        return size < EMBED_SMALL_LIMIT
+    return embed == "always"
+
+
+def transcode_png(data, image_format):
+    """Re-encode PNG bytes as JPEG/WebP. Returns (content_type, data).
+
+    The original PNG is kept when re-encoding does not shrink it, which is
+    common for flat terminal screenshots.
+    """
+    if image_format == "png" or Image is None or len(data) < TRANSCODE_MIN_SIZE:
+        return "image/png", data
+    buf = io.BytesIO()
+    try:
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+        img.save(buf, format=image_format.upper(), quality=TRANSCODE_QUALITY, optimize=False)
+    except OSError:
+        # Not a decodable image; embed the original bytes
+        return "image/png", data
+    if buf.tell() >= len(data):
+        return "image/png", data
+    return f"image/{image_format}", buf.getvalue()
+
+
+def export_asset(path, assets_dir):
+    """Copy an image file into the assets directory and return its relative URL."""
+    path = Path(path)
+    # Playwright reuses attachment names across tests, so key on the full path
+    digest = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:10]
+    name = f"{digest}-{path.name}"
+    assets_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(path, assets_dir / name)
+    return f"{quote(assets_dir.name)}/{quote(name)}"
+
+
+def write_asset(data, content_type, assets_dir):
+    """Write decoded image bytes into the assets directory and return the relative URL."""
+    ext = mimetypes.guess_extension(content_type) or ".bin"
+    name = hashlib.sha1(data).hexdigest()[:16] + ext
+    assets_dir.mkdir(parents=True, exist_ok=True)
+    (assets_dir / name).write_bytes(data)
+    return f"{quote(assets_dir.name)}/{name}"
+
+
+def img_from_attachment(att, images=DEFAULT_IMAGE_OPTS):
+    """Return the src of an image attachment as an iterable of fragments.
+
+    Attachments stored on disk are encoded lazily while the report is written,
+    unless they are PNGs being re-encoded to images["format"] or are listed in
+    images["shared_paths"] (encoded once and memoized), or the on-disk encode
+    cache is enabled. Images that are not embedded are linked from the assets
+    directory instead.
+    """
     body = att.get("body", "")
     path = att.get("path", "")
     content_type = att.get("contentType", "")
@@ -148,23 +401,133 @@ def img_from_attachment(att):
     if not content_type.startswith("image/"):
         return None
 
+    # The body is interpolated into the src attribute verbatim, so anything
+    # that is not plain base64 is dropped rather than escaped
+    if body and not BASE64_RE.fullmatch(body):
+        return None
+
+    embed = images["embed"]
+    assets_dir = images["assets_dir"]
+    transcode = content_type == "image/png" and images["format"] != "png"
+
     if body:
-        return f"data:{content_type};base64,{body}"
+        # Decoded size of the base64 body, ignoring padding
+        size = len(body) * 3 // 4
+        if not should_embed(size, embed):
+            return (write_asset(b64decode(body), content_type, assets_dir),)
+        if transcode and size >= TRANSCODE_MIN_SIZE:
+            content_type, data = transcode_png(b64decode(body), images["format"])
+            return (f"data:{esc(content_type)};base64,", b64encode_str(data))
+        return (f"data:{esc(content_type)};base64,", body)
 
     if path and os.path.exists(path):
-        with open(path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-        return f"data:{content_type};base64,{b64}"
+        size = os.path.getsize(path)
+        if not should_embed(size, embed):
+            return (export_asset(path, assets_dir),)
+        if images["cache"] is not None:
+            content_type, b64 = encode_file_with_cache(path, content_type, images)
+            return (f"data:{esc(content_type)};base64,", b64)
+        if path in images.get("shared_paths", ()):
+            content_type, b64 = encode_file_cached(path, os.path.getmtime(path),
+                                                   content_type, images["format"])
+            return (f"data:{esc(content_type)};base64,", b64)
+        if transcode and size >= TRANSCODE_MIN_SIZE:
+            content_type, b64 = encode_file(path, content_type, images["format"], size)
+            return (f"data:{esc(content_type)};base64,", b64)
+        return itertools.chain((f"data:{esc(content_type)};base64,",), stream_b64(path, size))
 
     return None
 
 
+def encode_file(path, content_type, image_format, size=None):
+    """Base64-encode an image file, re-encoding large PNGs. Returns (content_type, b64).
+
+    Pass size when the caller already has it, to skip another stat.
+    """
+    if content_type == "image/png" and image_format != "png":
+        if size is None:
+            size = os.path.getsize(path)
+        if size >= TRANSCODE_MIN_SIZE:
+            with open(path, "rb") as f:
+                content_type, data = transcode_png(f.read(), image_format)
+            return content_type, b64encode_str(data)
+    return content_type, read_b64(path, size)
+
+
+@lru_cache(maxsize=512)
+def encode_file_cached(path, mtime, content_type, image_format):
+    """encode_file memoized on (path, mtime), for screenshots attached to several results."""
+    return encode_file(path, content_type, image_format)
+
+
+def encode_file_with_cache(path, content_type, images, st=None):
+    """encode_file through images["cache"], reusing entries whose mtime and size match."""
+    cache = images["cache"]
+    if cache is None:
+        return encode_file(path, content_type, images["format"], st and st.st_size)
+
+    st = st or os.stat(path)
+    key = os.path.abspath(path)
+    stamp = [st.st_mtime_ns, st.st_size, images["format"]]
+    # Check this run's entries first, so a file attached to several results
+    # is encoded once even when the cache on disk is cold or stale
+    entry = cache["used"].get(key) or cache["entries"].get(key)
+    if entry is None or entry[:3] != stamp:
+        entry = stamp + list(encode_file(path, content_type, images["format"], st.st_size))
+    cache["used"][key] = entry
+    return entry[3], entry[4]
+
+
+def load_encode_cache(cache_path):
+    """Load the encode cache: abs path -> [mtime_ns, size, format, content_type, b64]."""
+    try:
+        cache = json_loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    # Malformed entries are treated as misses, like a corrupt file
+    return {path: entry for path, entry in cache.items()
+            if isinstance(entry, list) and len(entry) == 5}
+
+
+def save_encode_cache(cache_path, entries):
+    """Write the encode cache atomically, so an interrupted run cannot corrupt it."""
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_bytes(json_dumps(entries))
+    os.replace(tmp_path, cache_path)
+
+
+def read_b64(path, size=None):
+    """Base64-encode a whole file from an mmap, without reading it into bytes first."""
+    with open(path, "rb") as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        # mmap cannot map an empty file
+        if size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return b64encode_str(mm)
+
+
+def stream_b64(path, size=None):
+    """Yield the base64 encoding of a file in fixed-size chunks."""
+    with open(path, "rb") as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for i in range(0, len(view), STREAM_CHUNK):
+                yield b64encode_str(view[i:i + STREAM_CHUNK])
+
+
 def text_from_attachment(att):
     """Extract text content from an attachment."""
     body = att.get("body", "")
     if body:
         try:
-            return base64.b64decode(body).decode("utf-8", errors="replace")
+            return b64decode(body).decode("utf-8", errors="replace")
         except Exception:
             return body
     path = att.get("path", "")
@@ -174,36 +537,49 @@ def text_from_attachment(att):
     return None
 
 
-def match_test_to_frames(test_title, frames):
+def build_frame_index(frames):
+    """Build an inverted index from lowercase words to frame-group prefixes."""
+    words = defaultdict(set)
+    for prefix in frames:
+        for word in set(prefix.lower().split("-")):
+            words[word].add(prefix)
+    return {
+        "words": words,
+        # Position of each prefix, so ties go to the first group as before
+        "rank": {prefix: i for i, prefix in enumerate(frames)},
+        # Normalized title -> best prefix; titles repeat across projects
+        "matches": {},
+    }
+
+
+def match_test_to_frames(test_title, frame_index):
     """Find the best matching frame group for a test title."""
     # Normalize test title to match frame prefixes
-    import re
-    normalized = re.sub(r"[^a-zA-Z0-9]+", "-", test_title).strip("-").lower()
+    normalized = NORM_RE.sub("-", test_title).strip("-").lower()
 
-    best_match = None
-    best_score = 0
+    matches = frame_index["matches"]
+    if normalized in matches:
+        return matches[normalized]
 
-    for prefix in frames:
-        prefix_lower = prefix.lower()
-        # Count matching words
-        title_words = set(normalized.split("-"))
-        prefix_words = set(prefix_lower.split("-"))
-        overlap = len(title_words & prefix_words)
-        if overlap > best_score:
-            best_score = overlap
-            best_match = prefix
+    # Count matching words per prefix via the index
+    words = frame_index["words"]
+    title_words = set(normalized.split("-"))
+    scores = Counter(itertools.chain.from_iterable(words.get(w, ()) for w in title_words))
 
-    return best_match if best_score >= 3 else None
+    best_match = None
+    if scores:
+        rank = frame_index["rank"]
+        best_score = max(scores.values())
+        if best_score >= 3:
+            best_match = min((p for p, n in scores.items() if n == best_score),
+                             key=rank.__getitem__)
+
+    matches[normalized] = best_match
+    return best_match
 
 
 def status_badge(status):
-    if status == "passed":
-        return '<span class="badge pass">PASSED</span>'
-    elif status == "failed":
-        return '<span class="badge fail">FAILED</span>'
-    elif status == "skipped":
-        return '<span class="badge skip">SKIPPED</span>'
-    return f'<span class="badge">{status.upper()}</span>'
+    return BADGES.get(status) or f'<span class="badge">{esc(status.upper())}</span>'
 
 
 def format_duration(ms):
@@ -215,16 +591,16 @@ def format_duration(ms):
     return f"{m}m {s:.0f}s"
 
 
-def render_html(tests, frames, video_rel, start_time, duration_ms):
-    # Group tests by suite
-    suites = {}
-    for t in tests:
-        s = t["suite"] or "Ungrouped"
-        suites.setdefault(s, []).append(t)
+def render_html(suites, passed, failed, total, frames, video_rel, start_time, duration_ms,
+                images=DEFAULT_IMAGE_OPTS):
+    """Yield the report HTML as a sequence of string fragments."""
+    frame_index = build_frame_index(frames)
 
-    passed = sum(1 for t in tests if t["status"] == "passed")
-    failed = sum(1 for t in tests if t["status"] == "failed")
-    total = len(tests)
+    # Retries attach the same screenshot file to several results; encode
+    # those once and stream the rest
+    path_counts = Counter(att["path"] for suite_tests in suites.values()
+                          for t in suite_tests for att in t["attachments"] if att.get("path"))
+    images = {**images, "shared_paths": {p for p, n in path_counts.items() if n > 1}}
 
     # Format timestamp
     try:
@@ -233,26 +609,19 @@ def render_html(tests, frames, video_rel, start_time, duration_ms):
     except Exception:
         time_str = start_time
 
-    test_sections = []
-
-    for suite_name, suite_tests in suites.items():
-        for t in suite_tests:
-            section = render_test_section(t, frames)
-            test_sections.append(section)
-
     video_section = ""
     if video_rel:
         video_section = f'''
     <section class="video-section">
       <h2>Full Recording</h2>
       <video controls width="360" preload="metadata">
-        <source src="{video_rel}" type="video/mp4">
+        <source src="{esc(video_rel)}" type="video/mp4">
         Your browser does not support video playback.
       </video>
-      <p class="video-link"><a href="{video_rel}" download>Download recording</a></p>
+      <p class="video-link"><a href="{esc(video_rel)}" download>Download recording</a></p>
     </section>'''
 
-    return f'''<!DOCTYPE html>
+    yield f'''<!DOCTYPE html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
@@ -315,7 +684,7 @@ a {{ color: #58a6ff; }}
 <body>
 
 <h1>Workflow Exploration Report</h1>
-<p class="timestamp">Generated {time_str} / Total duration: {format_duration(duration_ms)}</p>
+<p class="timestamp">Generated {esc(time_str)} / Total duration: {format_duration(duration_ms)}</p>
 
 <div class="summary">
   <div class="stat"><div class="label">Total</div><div class="value">{total}</div></div>
@@ -323,7 +692,13 @@ a {{ color: #58a6ff; }}
   <div class="stat"><div class="label">Failed</div><div class="value fail">{failed}</div></div>
 </div>
 
-{"".join(test_sections)}
+'''
+
+    for suite_tests in suites.values():
+        for t in suite_tests:
+            yield from render_test_section(t, frames, frame_index, images)
+
+    yield f'''
 
 {video_section}
 
@@ -338,7 +713,8 @@ document.querySelectorAll('.step img, .frame img').forEach(img => {{
 </html>'''
 
 
-def render_test_section(test, frames):
+def render_test_section(test, frames, frame_index, images=DEFAULT_IMAGE_OPTS):
+    """Yield the HTML fragments for a single test result."""
     title = test["title"]
     status = test["status"]
     duration = test["duration"]
@@ -346,12 +722,15 @@ def render_test_section(test, frames):
     header = f'''
     <div class="test-header">
       <div>
-        <span class="title">{title}</span>
+        <span class="title">{esc(title)}</span>
         <span class="meta">{format_duration(duration)}</span>
       </div>
       {status_badge(status)}
     </div>'''
 
+    # Each body part is an iterable of fragments; image payloads and text
+    # attachments stay separate fragments (or lazy streams) rather than being
+    # formatted into the markup
     body_parts = []
 
     # Error message
@@ -360,7 +739,7 @@ def render_test_section(test, frames):
         err = test["error"]
         if len(err) > 500:
             err = err[:500] + "..."
-        body_parts.append(f'<div class="error-box">{err}</div>')
+        body_parts.append((f'<div class="error-box">{html.escape(err)}</div>',))
 
     # Step screenshots and text attachments
     for att in test["attachments"]:
@@ -372,75 +751,66 @@ def render_test_section(test, frames):
             continue
 
         if content_type.startswith("image/"):
-            src = img_from_attachment(att)
+            if not images["include"]:
+                continue
+            src = img_from_attachment(att, images)
             if src:
                 # Generate narrative from step name
                 narrative = step_narrative(name)
-                body_parts.append(f'''
+                body_parts.append(itertools.chain((f'''
       <div class="step">
-        <div class="step-label">{name}</div>
-        {f'<div class="narrative">{narrative}</div>' if narrative else ''}
-        <img src="{src}" alt="{name}" loading="lazy">
-      </div>''')
+        <div class="step-label">{esc(name)}</div>
+        {f'<div class="narrative">{esc(narrative)}</div>' if narrative else ''}
+        <img src="''',), src, (f'''" alt="{esc(name)}" loading="lazy">
+      </div>''',)))
 
         elif content_type == "text/plain":
             text = text_from_attachment(att)
             if text:
-                body_parts.append(f'''
+                body_parts.append((f'''
       <div class="step">
-        <div class="step-label">{name}</div>
-        <div class="step-text">{text}</div>
-      </div>''')
+        <div class="step-label">{esc(name)}</div>
+        <div class="step-text">''', html.escape(text), '''</div>
+      </div>'''))
 
     # Match video frames
-    frame_key = match_test_to_frames(title, frames)
+    frame_key = match_test_to_frames(title, frame_index) if images["include"] else None
     if frame_key and frames.get(frame_key):
-        frame_items = []
-        for fr in frames[frame_key]:
-            label = fr["label"].replace("-", " ").replace("end ", "end: ")
-            frame_items.append(f'''
-        <div class="frame">
-          <img src="data:image/png;base64,{fr['b64']}" alt="{fr['filename']}" loading="lazy">
-          <div class="frame-label">{label}</div>
-        </div>''')
-
-        body_parts.append(f'''
+        frame_items = ['''
       <div class="frames-section">
         <h3>Video Frames</h3>
         <div class="narrative">Extracted from screen recording at key moments during test execution</div>
-        <div class="frames-grid">{"".join(frame_items)}</div>
+        <div class="frames-grid">''']
+        for fr in frames[frame_key]:
+            label = fr["label"].replace("-", " ").replace("end ", "end: ")
+            frame_items += ['''
+        <div class="frame">
+          <img src="''', *fr["src"], f'''" alt="{esc(fr['filename'])}" loading="lazy">
+          <div class="frame-label">{esc(label)}</div>
+        </div>''']
+        frame_items.append('''</div>
       </div>''')
+        body_parts.append(frame_items)
 
-    body = "\n".join(body_parts) if body_parts else '<p class="narrative">No step data captured</p>'
-
-    return f'''
+    yield f'''
     <section class="test-section">
       {header}
-      <div class="test-body">{body}</div>
+      <div class="test-body">'''
+    if body_parts:
+        for i, part in enumerate(body_parts):
+            if i:
+                yield "\n"
+            yield from part
+    else:
+        yield '<p class="narrative">No step data captured</p>'
+    yield '''</div>
     </section>'''
 
 
 def step_narrative(step_name):
     """Generate a brief narrative description from the step screenshot name."""
-    narratives = {
-        "fresh-start": "Application loaded with cleared state (localStorage wiped, page reloaded)",
-        "connected": "SSH connection established via the test SSH server",
-        "scrollback-generated": "Terminal filled with scrollback content (seq 1 100)",
-        "after-swipe-up": "Vertical swipe up performed on terminal (scroll back through output)",
-        "after-second-swipe": "Second vertical swipe up (continued scrolling)",
-        "tmux-started": "tmux session started inside SSH connection",
-        "tmux-second-window": "Second tmux window created (Ctrl-B c)",
-        "after-swipe-left": "Horizontal swipe left (should trigger tmux prev window)",
-        "after-swipe-right": "Horizontal swipe right (should trigger tmux next window)",
-        "terminal-loaded": "Terminal view loaded, ready for interaction",
-        "settings-panel": "Navigated to Settings panel via tab bar",
-        "after-pinch-zoom-in": "Pinch-to-zoom gesture performed on settings panel",
-        "back-to-terminal": "Navigated back to terminal view after zoom test",
-    }
-    for key, desc in narratives.items():
-        if key in step_name:
-            return desc
-    return ""
+    m = NARRATIVE_RE.search(step_name)
+    return NARRATIVES[m.group(0)] if m else ""
 
 
 if __name__ == "__main__":